@@ -0,0 +1,243 @@
+import os, pickle
+import numpy as np
+import cv2
+import pypdfium2 as pdfium
+from collections import deque, OrderedDict
+from multiprocessing import Pool, cpu_count
+import instrument
+
+# --- CONFIG ---
+LOOKAHEAD = 60                            # Frames of pages rendered ahead of the assembler
+RENDER_WORKERS = max(1, cpu_count() // 4) # Page rasterizers running beside the frame pool
+DOC_POOL_SIZE = 8                         # Open PdfDocument handles kept per render worker
+GROUP_PAGES = 32                          # Max pages of one document per render task
+CACHE_FORMAT = "npz"                      # Disk tier: "npz" (compressed) or "npy" (raw, ~20x the disk)
+
+# --- DISK TIER ---
+# "npz": zlib-compressed, ~150 KB per text page at PDF scale 4 and still faster to load than PNG.
+# "npy": raw, loads with a single read but costs W*H bytes per page (~4 MB at scale 4, ~20x npz).
+# Pages in any of the formats (and old .png caches) are read whatever CACHE_FORMAT says.
+FORMATS = (".npz", ".npy", ".png")
+
+def cache_path(atlas_dir, pid, ext=None):
+    return os.path.join(atlas_dir, f"{pid}{ext or '.' + CACHE_FORMAT}")
+
+def _find_page(atlas_dir, pid):
+    for ext in (f".{CACHE_FORMAT}",) + FORMATS:
+        path = cache_path(atlas_dir, pid, ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def page_cached(atlas_dir, pid):
+    return _find_page(atlas_dir, pid) is not None
+
+def save_page(atlas_dir, pid, gray):
+    # Write-then-rename so a reader never sees a half-written page
+    tmp = cache_path(atlas_dir, pid) + ".tmp"
+    instrument.count("atlas.bytes_written", gray.nbytes)
+    with instrument.span("atlas.save"), open(tmp, "wb") as f:
+        if CACHE_FORMAT == "npz": np.savez_compressed(f, page=gray)
+        else: np.save(f, gray)
+    os.replace(tmp, cache_path(atlas_dir, pid))
+
+def load_page(atlas_dir, pid):
+    """Grayscale page from the disk tier, or None if it was never rendered."""
+    path = _find_page(atlas_dir, pid)
+    with instrument.span("atlas.load"):
+        if path is None:
+            return None
+        if path.endswith(".npz"):
+            with np.load(path) as data:
+                return data["page"]
+        if path.endswith(".npy"):
+            return np.load(path)
+        return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+def cached_ids(atlas_dir):
+    """All page IDs present in an atlas folder, in any format."""
+    return sorted({int(f.split('.')[0]) for f in os.listdir(atlas_dir) if f.endswith(FORMATS)})
+
+# --- DOCUMENT HANDLE POOL (per worker) ---
+_DOCS = OrderedDict()
+
+def open_document(path):
+    """LRU pool of open documents so a PDF is parsed once per worker, not once per page."""
+    if path in _DOCS:
+        _DOCS.move_to_end(path)
+        instrument.count("doc_pool.hits")
+        return _DOCS[path]
+    instrument.count("doc_pool.misses")
+    with instrument.span("pdf.open"):
+        doc = pdfium.PdfDocument(path)
+    _DOCS[path] = doc
+    if len(_DOCS) > DOC_POOL_SIZE:
+        _, old = _DOCS.popitem(last=False)
+        old.close()
+    return doc
+
+def render_gray(path, pg_idx, scale):
+    """Rasterizes one page to grayscale through the handle pool."""
+    page = open_document(path)[pg_idx]
+    with instrument.span("pdf.render"):
+        bitmap = page.render(scale=scale).to_numpy()
+        return cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
+
+# --- MANIFESTS ---
+def manifest_pids(instructions):
+    """PDF page IDs referenced by one manifest (solid fills excluded)."""
+    return {e[4] for e in instructions if e[4] is not None and e[4] >= 0}
+
+def read_manifests(manifest_dir, manifest_files):
+    """Streams (m_file, pids) in manifest order without scanning everything up front."""
+    for m_file in manifest_files:
+        try:
+            with open(os.path.join(manifest_dir, m_file), "rb") as f:
+                pids = manifest_pids(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pids = set() # Left to the frame worker to deal with
+        yield m_file, pids
+
+def evict(cache, live):
+    """Drops cached pages that no upcoming frame references."""
+    for pid in [p for p in cache if p not in live]:
+        del cache[pid]
+
+def group_by_document(pids, registry):
+    """Splits pages into (path, [(pid, pg_idx), ...]) tasks, ordered by document and page."""
+    pages = sorted((registry[pid][0], registry[pid][1], pid) for pid in pids)
+    tasks = []
+    for path, idx, pid in pages:
+        if tasks and tasks[-1][0] == path and len(tasks[-1][1]) < GROUP_PAGES:
+            tasks[-1][1].append((pid, idx))
+        else:
+            tasks.append((path, [(pid, idx)]))
+    return tasks
+
+class AtlasScheduler:
+    """Rasterizes atlas pages a fixed number of frames ahead of frame assembly.
+
+    Walks the frames in order, submits every page of the next `lookahead` frames
+    to a worker pool and only releases a frame once all of its pages are done.
+    Pages that leave the window are forgotten (and re-submitted if they come back).
+
+    New pages are grouped by source document, so render_fn receives
+    (path, [(pid, pg_idx), ...]) and returns ({pid: result}, n_rendered, seconds),
+    where n_rendered counts pages actually rasterized rather than found in a cache
+    and seconds is the time render_fn itself spent on the task.
+    """
+
+    def __init__(self, render_fn, registry, lookahead=LOOKAHEAD, workers=RENDER_WORKERS):
+        self.render_fn = render_fn
+        self.registry = registry
+        self.lookahead = lookahead
+        self.pending = {}          # pid -> AsyncResult of its document group
+        self.refs = {}             # pid -> frames in the window that use it
+        self.rendered = 0
+        self.requested = 0
+        self.busy = 0.0            # Worker seconds spent inside render_fn
+        # Created here so the workers fork from the main thread, before any frame pool
+        self.pool = Pool(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.terminate()
+
+    def _done(self, result):
+        # Runs on the pool's result thread
+        self.rendered += result[1]
+        self.busy += result[2]
+
+    def _admit(self, pids):
+        new = []
+        for pid in pids:
+            self.refs[pid] = self.refs.get(pid, 0) + 1
+            if pid not in self.pending:
+                new.append(pid)
+        for task in group_by_document(new, self.registry):
+            res = self.pool.apply_async(self.render_fn, (task,), callback=self._done)
+            self.requested += len(task[1])
+            for pid, _ in task[1]:
+                self.pending[pid] = res
+
+    def _retire(self, pids):
+        for pid in pids:
+            self.refs[pid] -= 1
+            if not self.refs[pid]:
+                del self.refs[pid]
+                res = self.pending.pop(pid)
+                # Pages of one document share a result; drop this page's data now,
+                # not when the last of its siblings leaves the window
+                if res.ready() and res.successful():
+                    res.get()[0].pop(pid, None)
+
+    def get(self, pid):
+        """Result of render_fn for a page of the current window."""
+        return self.pending[pid].get()[0][pid]
+
+    def resident(self):
+        """Page results still held in memory; never more than the pages of the window."""
+        done = {id(r): r for r in self.pending.values() if r.ready() and r.successful()}
+        return sum(len(r.get()[0]) for r in done.values())
+
+    def summary(self):
+        """Atlas build throughput per busy worker second.
+
+        Rendering is lazy, so wall time would mostly measure how fast frames are consumed.
+        """
+        rate = self.rendered / self.busy if self.busy > 0 else 0.0
+        return (f"--- Atlas: {self.rendered} pages rendered, {self.requested - self.rendered} from cache, "
+                f"{rate:.1f} pages/s per worker ({self.busy:.1f}s busy) ---")
+
+    def schedule(self, frames):
+        """Yields (item, live_pids) for each (item, pids) once that frame's pages are ready.
+
+        live_pids covers the current frame and the lookahead window, so consumers can
+        evict anything outside it. Safe to hand straight to Pool.imap.
+        """
+        frames = iter(frames)
+        window = deque()
+        while True:
+            while len(window) <= self.lookahead:
+                frame = next(frames, None)
+                if frame is None: break
+                window.append(frame)
+                self._admit(frame[1])
+            if not window: return
+
+            item, pids = window[0]
+            with instrument.span("atlas.wait"):
+                for pid in pids:
+                    self.pending[pid].wait()
+            yield item, frozenset(self.refs)
+            window.popleft()
+            self._retire(pids)
+
+# --- SELF-CHECK (python atlas.py) ---
+def _fake_render(task):
+    path, pages = task
+    return {pid: np.zeros((64, 64), dtype=np.uint8) for pid, _ in pages}, len(pages), 0.0
+
+def check_residency(n_frames=200, lookahead=LOOKAHEAD):
+    """Page 0 is in every frame and arrives with a whole document of siblings that are
+    never used again, like a hero page; held results must stay within the window."""
+    registry = [(f"doc{i // GROUP_PAGES}.pdf", i % GROUP_PAGES) for i in range(GROUP_PAGES + n_frames)]
+    frames = [(0, set(range(GROUP_PAGES)))] + [(i, {0, GROUP_PAGES + i}) for i in range(1, n_frames)]
+    worst = 0
+    with AtlasScheduler(_fake_render, registry, lookahead, workers=2) as sched:
+        for i, live in sched.schedule(frames):
+            for pid in frames[i][1]:
+                sched.get(pid)
+            worst = max(worst, sched.resident() - len(live))
+    return worst
+
+if __name__ == "__main__":
+    excess = check_residency()
+    if excess > 0:
+        print(f"ERROR: up to {excess} page results held beyond the lookahead window"); raise SystemExit(1)
+    print("--- OK: page results never outlive the lookahead window ---")
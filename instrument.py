@@ -0,0 +1,186 @@
+import os, json, time, shutil, resource, threading, multiprocessing
+from contextlib import nullcontext
+
+# --- CONFIG ---
+# Off unless BADAPPLE_TRACE is set, e.g. BADAPPLE_TRACE=trace.json python job2_greedy_render.py
+# ("1" picks the default path). Open the result in chrome://tracing or ui.perfetto.dev.
+_FLAG = os.environ.get("BADAPPLE_TRACE", "")
+ENABLED = _FLAG not in ("", "0")
+TRACE_PATH = "badapple_trace.json" if _FLAG == "1" else _FLAG
+PARTS_DIR = TRACE_PATH + ".parts"   # One event file per process, merged by finish()
+RSS_INTERVAL = 0.5                  # Seconds between RSS samples per process
+
+_NULL = nullcontext()
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Per-process state; reset when a forked pool worker writes its first event
+_OWNER = None
+_FILE = None
+_LOCK = threading.Lock()
+_LOCAL = threading.local() # Open spans of this thread, for tally()
+_LAST_RSS = 0.0
+
+def _now():
+    return time.monotonic_ns() // 1000 # Shared clock across processes on Linux, in us
+
+def _emit(event):
+    global _OWNER, _FILE, _LAST_RSS
+    pid = os.getpid()
+    if _OWNER != pid:
+        _OWNER, _LAST_RSS = pid, 0.0
+        os.makedirs(PARTS_DIR, exist_ok=True)
+        # Line buffered: pool workers are terminated, not shut down, so nothing may sit in a buffer
+        _FILE = open(os.path.join(PARTS_DIR, f"{pid}.jsonl"), "a", buffering=1)
+        _FILE.write(json.dumps({"name": "process_name", "ph": "M", "pid": pid,
+                                "args": {"name": multiprocessing.current_process().name}}) + "\n")
+    event["pid"] = pid
+    line = json.dumps(event) + "\n"
+    with _LOCK:
+        _FILE.write(line)
+
+def _stack():
+    # A forked worker inherits its parent's open spans; those are not ours
+    if getattr(_LOCAL, "pid", None) != os.getpid():
+        _LOCAL.pid, _LOCAL.stack = os.getpid(), []
+    return _LOCAL.stack
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Peak, not current
+
+def _sample_rss(force=False):
+    global _LAST_RSS
+    now = time.monotonic()
+    if force or now - _LAST_RSS >= RSS_INTERVAL:
+        _LAST_RSS = now
+        _emit({"name": "rss_mb", "ph": "C", "ts": _now(), "args": {"rss_mb": round(rss_mb(), 1)}})
+
+class _Span:
+    def __init__(self, name, args):
+        self.name, self.args, self.tallies = name, args, {}
+
+    def __enter__(self):
+        _stack().append(self)
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        self.faults = (ru.ru_minflt, ru.ru_majflt)
+        self.ts = _now()
+        return self
+
+    def __exit__(self, *exc):
+        end = _now()
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        stack = _stack()
+        if stack and stack[-1] is self: stack.pop()
+        args = dict(self.args, minflt=ru.ru_minflt - self.faults[0], majflt=ru.ru_majflt - self.faults[1])
+        for name, (calls, us) in self.tallies.items():
+            args[f"{name}_calls"], args[f"{name}_ms"] = calls, us / 1000
+        _emit({"name": self.name, "ph": "X", "ts": self.ts, "dur": end - self.ts,
+               "tid": threading.get_native_id(), "args": args})
+        _sample_rss()
+
+class _Tally:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = _now()
+
+    def __exit__(self, *exc):
+        stack = _stack()
+        if stack:
+            t = stack[-1].tallies.setdefault(self.name, [0, 0])
+            t[0] += 1
+            t[1] += _now() - self.t0
+
+def span(name, **args):
+    """Times a block as one trace event (plus page faults and an RSS sample)."""
+    return _Span(name, args) if ENABLED else _NULL
+
+def tally(name):
+    """For per-tile hot spots: sums time into the enclosing span instead of one event per call."""
+    return _Tally(name) if ENABLED else _NULL
+
+def count(name, value=1):
+    """Records a counter sample (tiles per frame, cache hits, bytes written...)."""
+    if ENABLED:
+        _emit({"name": name, "ph": "C", "ts": _now(), "args": {name: value}})
+
+def timed(name, iterable):
+    """Wraps an iterator so the time spent waiting on each item becomes a span."""
+    if not ENABLED:
+        return iterable
+    def gen():
+        it = iter(iterable)
+        while True:
+            with span(name):
+                try: item = next(it)
+                except StopIteration: return
+            yield item
+    return gen()
+
+def _load_events():
+    events = []
+    if not os.path.isdir(PARTS_DIR): return events
+    for part in sorted(os.listdir(PARTS_DIR)):
+        with open(os.path.join(PARTS_DIR, part)) as f:
+            for line in f:
+                try: events.append(json.loads(line))
+                except ValueError: pass # Worker killed mid-line
+    return events
+
+def summary(events):
+    spans, counters, rss, names = {}, {}, {}, {}
+    tallies = set() # Rows summed from tally(); no max or page faults recorded for them
+    for e in events:
+        if e["ph"] == "X":
+            s = spans.setdefault(e["name"], [0, 0, 0, 0, 0])
+            s[0] += 1; s[1] += e["dur"]; s[2] = max(s[2], e["dur"])
+            s[3] += e["args"].get("minflt", 0); s[4] += e["args"].get("majflt", 0)
+            for key, ms in e["args"].items():
+                if key.endswith("_ms"):
+                    tallies.add(f"{e['name']}/{key[:-3]}")
+                    t = spans.setdefault(f"{e['name']}/{key[:-3]}", [0, 0, 0, 0, 0])
+                    t[0] += e["args"][key[:-3] + "_calls"]; t[1] += ms * 1000
+        elif e["ph"] == "C" and e["name"] == "rss_mb":
+            rss[e["pid"]] = max(rss.get(e["pid"], 0), e["args"]["rss_mb"])
+        elif e["ph"] == "C":
+            c = counters.setdefault(e["name"], [0, 0])
+            c[0] += 1; c[1] += e["args"][e["name"]]
+        elif e["ph"] == "M":
+            names[e["pid"]] = e["args"]["name"]
+
+    lines = [f"{'span':<32} {'calls':>9} {'total s':>10} {'mean ms':>9} {'max ms':>9} {'minflt':>10} {'majflt':>7}"]
+    for name, (calls, total, mx, minflt, majflt) in sorted(spans.items(), key=lambda kv: -kv[1][1]):
+        mean = total / calls / 1000 if calls else 0
+        line = f"{name:<32} {calls:>9} {total / 1e6:>10.2f} {mean:>9.2f}"
+        if name not in tallies:
+            line += f" {mx / 1000:>9.2f} {minflt:>10} {majflt:>7}"
+        lines.append(line)
+    if counters:
+        lines.append(f"\n{'counter':<32} {'samples':>9} {'total':>14} {'mean':>12}")
+        for name, (n, total) in sorted(counters.items()):
+            lines.append(f"{name:<32} {n:>9} {total:>14,.0f} {total / n:>12,.1f}")
+    if rss:
+        lines.append(f"\n{'process':<32} {'peak RSS MB':>12}")
+        for pid, mb in sorted(rss.items(), key=lambda kv: -kv[1]):
+            lines.append(f"{names.get(pid, pid)!s:<32} {mb:>12.1f}")
+        lines.append(f"{'(sum of peaks)':<32} {sum(rss.values()):>12.1f}")
+    return "\n".join(lines)
+
+def finish():
+    """Main process only: merges all worker events into TRACE_PATH and prints the summary table."""
+    if not ENABLED: return
+    _sample_rss(force=True)
+    events = _load_events()
+    with open(TRACE_PATH, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(PARTS_DIR, ignore_errors=True)
+    print(f"--- Trace: {len(events)} events from {len({e['pid'] for e in events})} processes -> {TRACE_PATH} ---")
+    print(summary(events))
+
+# A fresh run must not merge events left over from an earlier one
+if ENABLED and multiprocessing.parent_process() is None:
+    shutil.rmtree(PARTS_DIR, ignore_errors=True)
@@ -1,57 +1,102 @@
 import os
+import hashlib
 import cv2
 import numpy as np
 import pypdfium2 as pdfium
-import ctypes
 import pickle
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
+from matcher import match_batch
+import instrument
 
 # --- CONFIG ---
 PDF_ROOT = "Epstein"          # Matches your folder name
 VIDEO_PATH = "badapple.mp4"   # Make sure you renamed your video to this!
 MANIFEST_DIR = "manifests"
 LIB_CACHE = "library.pkl"
-LIB_PATH = "./libmatch.so"    # Linux shared object for WSL
-
-# --- LOAD C LIBRARY ---
-if not os.path.exists(LIB_PATH):
-    print(f"ERROR: {LIB_PATH} not found. Did you compile match.c?")
-    exit()
-
-c_lib = ctypes.CDLL(LIB_PATH)
-c_lib.match_batch.argtypes = [
-    ctypes.POINTER(ctypes.c_uint64), # lib
-    ctypes.POINTER(ctypes.c_uint64), # targets
-    ctypes.c_int,                   # n_pages
-    ctypes.c_int,                   # num_targets
-    ctypes.POINTER(ctypes.c_int)    # results
-]
+THUMB_CACHE = "thumbs.npz"    # Low-res grayscale atlas for job2_proxy_render
+THUMB_SIZE = 64               # Same 64x64 image the signature is cut from
+# Matching backend (C kernel or NumPy) is picked in matcher.py / $BADAPPLE_MATCHER
 
 # --- WORKER FOR PARALLEL PDF PROCESSING ---
+def page_thumb(page):
+    """64x64 grayscale thumbnail plus the page's width/height ratio (to undo the squash)."""
+    # Fast render scale
+    bitmap = page.render(scale=0.3).to_numpy()
+    gray = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
+    aspect = gray.shape[1] / gray.shape[0]
+    return cv2.resize(gray, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA), aspect
+
 def render_worker(pdf_path):
     sigs = []
     meta = []
+    thumbs = []
+    with instrument.span("ingest.pdf"):
+        try:
+            pdf = pdfium.PdfDocument(pdf_path)
+            for i in range(len(pdf)):
+                resized, aspect = page_thumb(pdf[i])
+                _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
+                sigs.append(np.packbits(binary).view(np.uint64))
+                meta.append((pdf_path, i))
+                # Keep the thumbnail instead of throwing it away
+                thumbs.append((resized, aspect))
+            pdf.close()
+        except Exception:
+            pass
+    instrument.count("ingest.pages", len(meta))
+    return sigs, meta, thumbs
+
+def thumb_worker(task):
+    """Thumbnails for a library indexed before thumbnails were kept."""
+    pdf_path, pages = task
+    out = []
     try:
         pdf = pdfium.PdfDocument(pdf_path)
-        for i in range(len(pdf)):
-            page = pdf[i]
-            # Fast render scale
-            bitmap = page.render(scale=0.3).to_numpy()
-            gray = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
-            resized = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
-            _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
-            sigs.append(np.packbits(binary).view(np.uint64))
-            meta.append((pdf_path, i))
+        for rid, i in pages:
+            out.append((rid,) + page_thumb(pdf[i]))
         pdf.close()
     except Exception:
         pass
-    return sigs, meta
+    return out
+
+def library_fingerprint(registry):
+    """Hash of the (pdf_path, page) list, i.e. of what each page ID means."""
+    return hashlib.sha1(pickle.dumps([(str(p), int(i)) for p, i in registry])).hexdigest()
+
+def save_thumbs(thumbs, aspect, registry):
+    np.savez(THUMB_CACHE, thumbs=thumbs, aspect=np.asarray(aspect, dtype=np.float32),
+             library=library_fingerprint(registry))
+
+def build_thumbs(registry):
+    by_pdf = {}
+    for rid, (pdf_path, i) in enumerate(registry):
+        by_pdf.setdefault(pdf_path, []).append((rid, i))
+
+    # Pages that fail to render stay mid-gray with a square aspect
+    thumbs = np.full((len(registry), THUMB_SIZE, THUMB_SIZE), 127, dtype=np.uint8)
+    aspect = np.ones(len(registry), dtype=np.float32)
+    print(f"--- Building thumbnail atlas for {len(registry)} pages ---")
+    with ProcessPoolExecutor() as executor:
+        for out in tqdm(executor.map(thumb_worker, by_pdf.items()), total=len(by_pdf), desc="Thumbnails"):
+            for rid, thumb, a in out:
+                thumbs[rid], aspect[rid] = thumb, a
+    save_thumbs(thumbs, aspect, registry)
+
+def thumbs_stale(registry):
+    """True if thumbs.npz is missing or was written for a different library.pkl."""
+    if not os.path.exists(THUMB_CACHE):
+        return True
+    with np.load(THUMB_CACHE) as data:
+        return "library" not in data or str(data["library"]) != library_fingerprint(registry)
 
 def build_index():
     if os.path.exists(LIB_CACHE):
         print(f"--- Loading library from cache: {LIB_CACHE} ---")
-        return pickle.load(open(LIB_CACHE, "rb"))
+        data = pickle.load(open(LIB_CACHE, "rb"))
+        if thumbs_stale(data[0]):
+            build_thumbs(data[0])
+        return data
 
     all_pdfs = []
     for root, _, files in os.walk(PDF_ROOT):
@@ -63,21 +108,73 @@ def build_index():
         print(f"ERROR: No PDFs found in {PDF_ROOT}")
         return [], np.array([])
 
-    registry, signatures = [], []
+    registry, signatures, thumbs = [], [], []
     print(f"--- Indexing {len(all_pdfs)} PDFs using Parallel Multiprocessing ---")
     
     with ProcessPoolExecutor() as executor:
         results = list(tqdm(executor.map(render_worker, all_pdfs), total=len(all_pdfs), desc="Ingesting PDFs"))
         
-    for sig_list, meta_list in results:
+    for sig_list, meta_list, thumb_list in results:
         signatures.extend(sig_list)
         registry.extend(meta_list)
+        thumbs.extend(thumb_list)
 
     data = (registry, np.array(signatures, dtype=np.uint64))
     with open(LIB_CACHE, "wb") as f:
         pickle.dump(data, f)
+    save_thumbs(np.array([t for t, _ in thumbs], dtype=np.uint8).reshape(-1, THUMB_SIZE, THUMB_SIZE),
+                [a for _, a in thumbs], registry)
     return data
 
+# --- QUADTREE DECOMPOSITION ---
+def decompose_frame(gray):
+    """Splits one grayscale frame into solid tiles and detail tiles (bitmasks still to match)."""
+    tiles_to_match = []
+    manifest_template = []
+    
+    def collect_tiles(x, y, w, h):
+        tile = gray[y:y+h, x:x+w]
+        var = np.var(tile)
+        # Threshold for solid areas
+        if var < 5:
+            manifest_template.append([x, y, w, h, -1 if np.mean(tile) < 127 else -2])
+        # Threshold for leaf nodes (match against PDFs)
+        elif w <= 32:
+            with instrument.tally("signature"):
+                resized = cv2.resize(tile, (64, 64), interpolation=cv2.INTER_AREA)
+                _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
+                tiles_to_match.append(np.packbits(binary).view(np.uint64))
+            manifest_template.append([x, y, w, h, None])
+        # Recursive split
+        else:
+            hw, hh = w // 2, h // 2
+            collect_tiles(x, y, hw, hh)
+            collect_tiles(x + hw, y, hw, hh)
+            collect_tiles(x, y + hh, hw, hh)
+            collect_tiles(x + hw, y + hh, hw, hh)
+
+    with instrument.span("decompose"):
+        collect_tiles(0, 0, 512, 384)
+    return manifest_template, tiles_to_match
+
+def arrange_frame(gray, signatures, n_pages):
+    """Quadtree manifest for one grayscale frame, detail tiles matched against the library."""
+    manifest_template, tiles_to_match = decompose_frame(gray)
+
+    if tiles_to_match:
+        batch_np = np.array(tiles_to_match, dtype=np.uint64)
+        
+        # CALL THE MATCH ENGINE
+        results = match_batch(signatures[:n_pages], batch_np)
+        
+        res_idx = 0
+        for i in range(len(manifest_template)):
+            if manifest_template[i][4] is None:
+                manifest_template[i][4] = int(results[res_idx])
+                res_idx += 1
+
+    return manifest_template
+
 # --- MAIN ARRANGER ---
 def run_arrangement():
     if not os.path.exists(MANIFEST_DIR):
@@ -97,54 +194,15 @@ def run_arrangement():
 
     frame_idx = 0
     while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret: break
-        
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        tiles_to_match = []
-        manifest_template = []
-        
-        def collect_tiles(x, y, w, h):
-            tile = gray[y:y+h, x:x+w]
-            var = np.var(tile)
-            # Threshold for solid areas
-            if var < 5:
-                manifest_template.append([x, y, w, h, -1 if np.mean(tile) < 127 else -2])
-            # Threshold for leaf nodes (match against PDFs)
-            elif w <= 32:
-                resized = cv2.resize(tile, (64, 64), interpolation=cv2.INTER_AREA)
-                _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
-                tiles_to_match.append(np.packbits(binary).view(np.uint64))
-                manifest_template.append([x, y, w, h, None])
-            # Recursive split
-            else:
-                hw, hh = w // 2, h // 2
-                collect_tiles(x, y, hw, hh)
-                collect_tiles(x + hw, y, hw, hh)
-                collect_tiles(x, y + hh, hw, hh)
-                collect_tiles(x + hw, y + hh, hw, hh)
+        with instrument.span("decode"):
+            ret, frame = cap.read()
+            if not ret: break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-        collect_tiles(0, 0, 512, 384)
+        manifest_template = arrange_frame(gray, signatures, n_pages)
+        instrument.count("tiles_per_frame", len(manifest_template))
 
-        if tiles_to_match:
-            batch_np = np.array(tiles_to_match, dtype=np.uint64)
-            results = np.zeros(len(tiles_to_match), dtype=np.int32)
-            
-            # CALL THE C ENGINE
-            c_lib.match_batch(
-                signatures.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)),
-                batch_np.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)),
-                n_pages, len(tiles_to_match),
-                results.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-            )
-            
-            res_idx = 0
-            for i in range(len(manifest_template)):
-                if manifest_template[i][4] is None:
-                    manifest_template[i][4] = int(results[res_idx])
-                    res_idx += 1
-
-        with open(f"{MANIFEST_DIR}/{frame_idx:04d}.bin", "wb") as f:
+        with instrument.span("write_manifest"), open(f"{MANIFEST_DIR}/{frame_idx:04d}.bin", "wb") as f:
             pickle.dump(manifest_template, f)
         
         frame_idx += 1
@@ -152,6 +210,7 @@ def run_arrangement():
 
     cap.release()
     pbar.close()
+    instrument.finish()
 
 if __name__ == "__main__":
     run_arrangement()
\ No newline at end of file
@@ -1,22 +1,17 @@
-import os, cv2, numpy as np, pickle, ctypes, hashlib
+import os, cv2, numpy as np, pickle, hashlib
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count, Manager
+from matcher import match_batch
+import instrument
 
 # --- CONFIG ---
 VIDEO_PATH = "badapple.mp4"   
 MANIFEST_DIR = "manifests_greedy"
 LIB_CACHE = "library.pkl"
-LIB_PATH = "./libmatch.so"
-os.makedirs(MANIFEST_DIR, exist_ok=True)
 
 # PARAMS
 MIN_BLOCK, MAX_BLOCK = 16, 256
 
-# C setup
-c_lib = ctypes.CDLL(LIB_PATH)
-c_lib.match_batch.argtypes = [ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_uint64), 
-                               ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
-
 def get_bitmask(img):
     resized = cv2.resize(img, (64, 64), interpolation=cv2.INTER_AREA)
     _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
@@ -35,8 +30,14 @@ def init_worker(sigs, n_pages, w_pool, b_pool):
     _W_POOL = w_pool
     _B_POOL = b_pool
 
-def solve_frame_parallel(task):
-    frame_idx, frame = task
+def hero_pools(sigs):
+    """100 blackest and 100 whitest pages, rotated per frame over solid regions."""
+    popcounts = [np.unpackbits(s.view(np.uint8)).sum() for s in sigs]
+    sorted_indices = np.argsort(popcounts)
+    return sorted_indices[:100].tolist(), sorted_indices[-100:].tolist()
+
+def solve_frame(frame_idx, frame):
+    """Builds the manifest of one frame using the worker globals set by init_worker."""
     h, w = frame.shape
     manifest = []
     edge_tasks = []
@@ -58,27 +59,30 @@ def solve_frame_parallel(task):
             split_rect(x, y + hh, hw, hh)
             split_rect(x + hw, y + hh, hw, hh)
 
-    for y in range(0, h, 128):
-        for x in range(0, w, 128):
-            split_rect(x, y, min(128, w-x), min(128, h-y))
+    with instrument.span("decompose"):
+        for y in range(0, h, 128):
+            for x in range(0, w, 128):
+                split_rect(x, y, min(128, w-x), min(128, h-y))
 
     if edge_tasks:
-        tiles = np.array([get_bitmask(frame[t[1]:t[1]+t[3], t[0]:t[0]+t[2]]) for t in edge_tasks], dtype=np.uint64)
-        results = np.zeros(len(tiles), dtype=np.int32)
-        c_lib.match_batch(_SIGS.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)), 
-                          tiles.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)), 
-                          _NPAGES, len(tiles), results.ctypes.data_as(ctypes.POINTER(ctypes.c_int)))
+        with instrument.span("signature"):
+            tiles = np.array([get_bitmask(frame[t[1]:t[1]+t[3], t[0]:t[0]+t[2]]) for t in edge_tasks], dtype=np.uint64)
+        results = match_batch(_SIGS[:_NPAGES], tiles)
         for i, task in enumerate(edge_tasks):
             manifest[task[4]][4] = int(results[i])
-            
-    with open(f"{MANIFEST_DIR}/{frame_idx:04d}.bin", "wb") as f:
+    return manifest
+
+def solve_frame_parallel(task):
+    frame_idx, frame = task
+    manifest = solve_frame(frame_idx, frame)
+    instrument.count("tiles_per_frame", len(manifest))
+    with instrument.span("write_manifest"), open(f"{MANIFEST_DIR}/{frame_idx:04d}.bin", "wb") as f:
         pickle.dump(manifest, f)
 
 def main():
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
     reg, sigs = pickle.load(open(LIB_CACHE, "rb"))
-    popcounts = [np.unpackbits(s.view(np.uint8)).sum() for s in sigs]
-    sorted_indices = np.argsort(popcounts)
-    b_pool, w_pool = sorted_indices[:100].tolist(), sorted_indices[-100:].tolist()
+    b_pool, w_pool = hero_pools(sigs)
 
     cap = cv2.VideoCapture(VIDEO_PATH)
     frames = []
@@ -88,13 +92,15 @@ def main():
     print("--- Phase 1: Temporal Analysis ---")
     idx = 0
     while True:
-        ret, frame = cap.read()
-        if not ret: break
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        with instrument.span("decode"):
+            ret, frame = cap.read()
+            if not ret: break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         
         # Check if we've seen this exact image before (Temporal Cache)
         f_hash = hashlib.md5(gray).hexdigest()
         if f_hash in frame_hashes:
+            instrument.count("temporal_cache.hits")
             # Just copy the existing manifest file
             source = f"{MANIFEST_DIR}/{frame_hashes[f_hash]:04d}.bin"
             target = f"{MANIFEST_DIR}/{idx:04d}.bin"
@@ -110,5 +116,6 @@ def main():
     # Solve only unique frames across all cores
     with Pool(cpu_count(), initializer=init_worker, initargs=(sigs, len(reg), w_pool, b_pool)) as p:
         list(tqdm(p.imap_unordered(solve_frame_parallel, tasks), total=len(tasks)))
+    instrument.finish()
 
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -1,7 +1,10 @@
-import os, cv2, numpy as np, pickle, pypdfium2 as pdfium, subprocess
+import os, cv2, numpy as np, pickle, subprocess, threading, time
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 import functools
+import atlas, instrument, membudget
+from atlas import AtlasScheduler, read_manifests, evict, page_cached, save_page, render_gray
+from membudget import bounded
 
 # --- CONFIG ---
 MANIFEST_DIR = "manifests_greedy"
@@ -14,32 +17,36 @@ SCALE_FACTOR = 15
 W, H = 512 * SCALE_FACTOR, 384 * SCALE_FACTOR
 FPS = 60 
 PDF_RENDER_SCALE = 3.0 # Optimal for 8K-16K
+LOOKAHEAD = 60         # Frames of pages rasterized ahead of assembly (upper bound, see membudget)
+PIPE_BUFFER = 10**8
+RENDER_WORKERS = max(1, cpu_count() // 4)
 
-# Shared Atlas Global
+# Per-worker atlas, holds only the pages of the current lookahead window
 _ATLAS = {}
 
-def worker_init(atlas_shared):
-    """Initializes each worker with access to the shared atlas."""
-    global _ATLAS
-    _ATLAS = atlas_shared
+def load_page(pid):
+    """Pulls a page rendered by the scheduler from the disk cache."""
+    if pid not in _ATLAS:
+        instrument.count("atlas.misses")
+        _ATLAS[pid] = atlas.load_page(ATLAS_DIR, pid)
+    return _ATLAS[pid]
 
-def render_single_frame(m_file):
+def assemble_frame(instructions, live, scale):
     """The core rendering function - optimized for speed."""
+    evict(_ATLAS, live)
     # Create a raw 1-channel canvas
-    canvas = np.full((H, W), 255, dtype=np.uint8)
-    
-    with open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
-        instructions = pickle.load(f)
+    canvas = np.full((384 * scale, 512 * scale), 255, dtype=np.uint8)
     
     for x, y, w, h, pid in instructions:
-        nx, ny, nw, nh = x*SCALE_FACTOR, y*SCALE_FACTOR, w*SCALE_FACTOR, h*SCALE_FACTOR
+        nx, ny, nw, nh = x*scale, y*scale, w*scale, h*scale
         
         # Solid colors are extremely fast
         if pid == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
         elif pid == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
         else:
             # Resize logic: Fast INTER_AREA for text
-            source_img = _ATLAS[pid]
+            source_img = load_page(pid)
+            if source_img is None: continue # Page failed to render
             # Maintain aspect ratio (letterboxing)
             ih, iw = source_img.shape
             as_src, as_tar = iw/ih, nw/nh
@@ -48,52 +55,51 @@ def render_single_frame(m_file):
             
             # Clamp sizes to 1px min
             tw, th = max(1, tw), max(1, th)
-            resized = cv2.resize(source_img, (tw, th), interpolation=cv2.INTER_AREA)
+            with instrument.tally("resize"):
+                resized = cv2.resize(source_img, (tw, th), interpolation=cv2.INTER_AREA)
             
             # Plaster centered
             y_off, x_off = (nh-th)//2, (nw-tw)//2
             canvas[ny+y_off:ny+y_off+th, nx+x_off:nx+x_off+tw] = resized
-            
+    return canvas
+
+def render_single_frame(task):
+    m_file, live = task
+    with instrument.span("load_manifest"), open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
+        instructions = pickle.load(f)
+    instrument.count("tiles_per_frame", len(instructions))
+    with instrument.span("assemble"):
+        canvas = assemble_frame(instructions, live, SCALE_FACTOR)
     # Piping as raw bytes (No headers = zero CPU overhead for formatting)
-    return canvas.tobytes()
+    with instrument.span("tobytes"):
+        return canvas.tobytes()
 
 def render_page_worker(task):
-    """Stage 1: Render PDFs to Disk."""
-    pid, path, idx = task
-    cp = f"{ATLAS_DIR}/{pid}.png"
-    if not os.path.exists(cp):
+    """Renders one document's pages to the disk cache, scheduled ahead of assembly."""
+    path, pages = task
+    t0, rendered = time.perf_counter(), 0
+    for pid, idx in pages:
+        if page_cached(ATLAS_DIR, pid): continue
         try:
-            pdf = pdfium.PdfDocument(path)
-            page = pdf[idx]
-            bitmap = page.render(scale=PDF_RENDER_SCALE).to_numpy()
-            gray = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
+            gray = render_gray(path, idx, PDF_RENDER_SCALE)
             # Simple contrast punch
             gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
-            cv2.imwrite(cp, gray)
-            pdf.close()
+            save_page(ATLAS_DIR, pid, gray)
+            rendered += 1
         except: pass
+    return {pid: None for pid, _ in pages}, rendered, time.perf_counter() - t0
 
 def main():
     if not os.path.exists(ATLAS_DIR): os.makedirs(ATLAS_DIR)
     reg, _ = pickle.load(open(LIB_CACHE, "rb"))
     manifests = sorted([f for f in os.listdir(MANIFEST_DIR) if f.endswith(".bin")])
-    
-    # 1. PRE-RENDER (Disk I/O Bound)
-    needed = {e[4] for f in manifests for e in pickle.load(open(f"{MANIFEST_DIR}/{f}","rb")) if e[4] >= 0}
-    tasks = [(i, reg[i][0], reg[i][1]) for i in needed]
-    
-    print(f"--- Stage 1: Disk Caching ---")
-    with Pool(cpu_count()) as p:
-        list(tqdm(p.imap_unordered(render_page_worker, tasks), total=len(tasks)))
 
-    # 2. LOAD ATLAS TO RAM (Once)
-    print(f"--- Stage 2: Loading Atlas to RAM ---")
-    atlas = {}
-    for pid in tqdm(needed, desc="Loading"):
-        atlas[pid] = cv2.imread(f"{ATLAS_DIR}/{pid}.png", cv2.IMREAD_GRAYSCALE)
-
-    # 3. PARALLEL ASSEMBLY (CPU Bound)
-    print(f"--- Stage 3: Assembling 16K Master ---")
+    # Workers, lookahead and frames in flight come from the memory budget (BADAPPLE_MEM_BUDGET)
+    pages = membudget.frame_pages(MANIFEST_DIR, manifests)
+    plan = membudget.plan(W * H, membudget.page_bytes(PDF_RENDER_SCALE), pages,
+                          LOOKAHEAD, render_workers=RENDER_WORKERS, pipe_buffer=PIPE_BUFFER)
+    print(membudget.describe(plan))
+    print(f"--- Assembling 16K Master ({plan.lookahead} frame lookahead) ---")
     
     # We use 'rawvideo' format to eliminate PGM/PNG overhead
     cmd = [
@@ -104,15 +110,20 @@ def main():
         '-movflags', '+faststart', '-fps_mode', 'cfr', 'temp_master.mov'
     ]
     
-    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=10**8)
-    
-    # Limiting workers to 75% of cores helps prevent RAM spikes in WSL
-    num_workers = max(1, int(cpu_count() * 0.75))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=PIPE_BUFFER)
     
-    with Pool(num_workers, initializer=worker_init, initargs=(atlas,)) as p:
+    slots = threading.Semaphore(plan.in_flight)
+    with AtlasScheduler(render_page_worker, reg, plan.lookahead, RENDER_WORKERS) as sched, \
+         Pool(plan.workers) as p, membudget.Governor(plan, slots, sched) as gov:
+        frames = bounded(sched.schedule(read_manifests(MANIFEST_DIR, manifests)), slots)
         # imap returns results in order, allowing smooth piping to FFmpeg
-        for frame_bytes in tqdm(p.imap(render_single_frame, manifests), total=len(manifests)):
-            proc.stdin.write(frame_bytes)
+        for frame_bytes in tqdm(instrument.timed("frame.wait", p.imap(render_single_frame, frames)), total=len(manifests)):
+            with instrument.span("ffmpeg.write"):
+                proc.stdin.write(frame_bytes)
+            instrument.count("ffmpeg.bytes", len(frame_bytes))
+            slots.release()
+        print(sched.summary())
+    print(gov.summary())
             
     proc.stdin.close(); proc.wait()
     
@@ -121,5 +132,6 @@ def main():
         subprocess.run(['ffmpeg', '-y', '-i', 'temp_master.mov', '-i', ORIGINAL_VIDEO,
                         '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'pcm_s16le',
                         '-shortest', 'BAD_APPLE_8K_YOUTUBE.mov'])
+    instrument.finish()
 
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os, cv2, numpy as np, pickle, subprocess
+from tqdm import tqdm
+from functools import lru_cache
+from job1_arrange import library_fingerprint
+import instrument
+
+# --- CONFIG ---
+# Quick-review renderer: assembles frames from the 64x64 thumbnails kept by
+# job1_arrange instead of rasterizing PDFs, so it never opens a PDF.
+MANIFEST_DIR = "manifests_greedy"
+LIB_CACHE = "library.pkl"
+THUMB_CACHE = "thumbs.npz"
+OUTPUT_VIDEO = "bad_apple_proxy.mp4"
+
+SCALE_FACTOR = 1 # 1x-2x; thumbnails hold no more detail than that
+FPS = 30
+
+_THUMBS = None
+_ASPECT = None
+
+def load_thumbs(path=THUMB_CACHE):
+    global _THUMBS, _ASPECT
+    data = np.load(path)
+    _THUMBS, _ASPECT = data["thumbs"], data["aspect"]
+
+def check_thumbs(registry, path=THUMB_CACHE):
+    """Error message if the thumbnails were not built from this exact page list, else None."""
+    with np.load(path) as data:
+        library = str(data["library"]) if "library" in data else None
+    if library != library_fingerprint(registry):
+        return (f"ERROR: {path} was built for a different {LIB_CACHE} (or before it was fingerprinted). "
+                f"Run job1_arrange to rebuild it!")
+
+@lru_cache(maxsize=20000)
+def get_tile(pid, nw, nh):
+    # Restore the page's aspect ratio and letterbox it like job2_greedy_render
+    as_src, as_tar = float(_ASPECT[pid]), nw/nh
+    tw, th = (nw, int(nw/as_src)) if as_src > as_tar else (int(nh*as_src), nh)
+    tw, th = max(1, tw), max(1, th)
+    interp = cv2.INTER_AREA if tw < _THUMBS.shape[2] else cv2.INTER_LINEAR
+    with instrument.tally("resize"):
+        return cv2.resize(_THUMBS[pid], (tw, th), interpolation=interp)
+
+def assemble_proxy(instructions, scale):
+    canvas = np.full((384 * scale, 512 * scale), 255, dtype=np.uint8)
+    for x, y, w, h, pid in instructions:
+        nx, ny, nw, nh = x*scale, y*scale, w*scale, h*scale
+        if pid == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
+        elif pid == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
+        elif pid is not None:
+            tile = get_tile(pid, nw, nh)
+            th, tw = tile.shape
+            y_off, x_off = (nh-th)//2, (nw-tw)//2
+            canvas[ny+y_off:ny+y_off+th, nx+x_off:nx+x_off+tw] = tile
+    return canvas
+
+def main():
+    if not os.path.exists(THUMB_CACHE):
+        print(f"ERROR: {THUMB_CACHE} not found. Run job1_arrange to build it!"); return
+    registry, _ = pickle.load(open(LIB_CACHE, "rb"))
+    error = check_thumbs(registry)
+    if error:
+        print(error); return
+    load_thumbs()
+    manifests = sorted([f for f in os.listdir(MANIFEST_DIR) if f.endswith(".bin")])
+
+    W, H = 512 * SCALE_FACTOR, 384 * SCALE_FACTOR
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(FPS), '-f', 'rawvideo',
+        '-pix_fmt', 'gray', '-s', f'{W}x{H}', '-i', '-',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18', '-pix_fmt', 'yuv420p', OUTPUT_VIDEO
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    print(f"--- Proxy render {W}x{H} from thumbnails ---")
+    for m_file in tqdm(manifests, desc="Proxy", unit="frame"):
+        with instrument.span("load_manifest"), open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
+            instructions = pickle.load(f)
+        with instrument.span("assemble"):
+            frame = assemble_proxy(instructions, SCALE_FACTOR)
+        with instrument.span("ffmpeg.write"):
+            proc.stdin.write(frame.tobytes())
+
+    proc.stdin.close(); proc.wait()
+    print(f"--- Proxy saved as {OUTPUT_VIDEO} ---")
+    instrument.finish()
+
+if __name__ == "__main__": main()
@@ -2,8 +2,10 @@ import cv2
 import numpy as np
 import pickle
 import os
-import pypdfium2 as pdfium
+import time
 from tqdm import tqdm
+from atlas import AtlasScheduler, read_manifests, render_gray
+import instrument, membudget
 
 # --- CONFIG ---
 MANIFEST_DIR = "manifests"
@@ -11,6 +13,17 @@ LIB_CACHE = "library.pkl"
 OUTPUT_VIDEO = "bad_apple_final.mp4"
 FRAME_SIZE = (512, 384)
 FPS = 30.0
+LOOKAHEAD = 60      # Frames of pages rendered ahead of the writer (upper bound, see membudget)
+PDF_RENDER_SCALE = 2.0
+RENDER_WORKERS = 4
+
+def render_page(task):
+    """Rasterizes one document's pages for the scheduler's worker pool."""
+    pdf_path, pages = task
+    t0 = time.perf_counter()
+    # Render at 2x scale for high detail in the tiles
+    result = {pid: render_gray(pdf_path, pg_idx, PDF_RENDER_SCALE) for pid, pg_idx in pages}
+    return result, len(pages), time.perf_counter() - t0
 
 def render_video():
     if not os.path.exists(LIB_CACHE):
@@ -21,66 +34,62 @@ def render_video():
     print("--- Loading Registry ---")
     registry, _ = pickle.load(open(LIB_CACHE, "rb"))
     
-    # Setup Video Writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(OUTPUT_VIDEO, fourcc, FPS, FRAME_SIZE)
-
     # Get sorted manifest files
     manifest_files = sorted([f for f in os.listdir(MANIFEST_DIR) if f.endswith(".bin")])
     if not manifest_files:
         print("ERROR: No manifests found in 'manifests/' folder.")
         return
 
-    # This dictionary will store rendered grayscale pages in RAM
-    # With 10GB of PDFs, this could grow, but you have high RAM capacity.
-    atlas = {}
-    
-    # Track open PDF documents to avoid overhead of opening/closing
-    open_docs = {}
+    # Pages are rendered by a worker pool ahead of this loop and dropped once no
+    # upcoming frame needs them. They are held here, so the window is sized to the budget.
+    plan = membudget.plan(FRAME_SIZE[0] * FRAME_SIZE[1] * 3, membudget.page_bytes(PDF_RENDER_SCALE),
+                          membudget.frame_pages(MANIFEST_DIR, manifest_files), LOOKAHEAD,
+                          max_workers=0, render_workers=RENDER_WORKERS)
+    print(membudget.describe(plan))
+
+    # Setup Video Writer
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(OUTPUT_VIDEO, fourcc, FPS, FRAME_SIZE)
+
+    sched = AtlasScheduler(render_page, registry, plan.lookahead, RENDER_WORKERS)
+    gov = membudget.Governor(plan, sched=sched)
+    gov.start()
+    frames = sched.schedule(read_manifests(MANIFEST_DIR, manifest_files))
 
     print(f"--- Rendering {len(manifest_files)} Frames ---")
-    for m_file in tqdm(manifest_files, desc="Rendering Video", unit="frame"):
+    for m_file, _ in tqdm(frames, total=len(manifest_files), desc="Rendering Video", unit="frame"):
         # Create a blank black canvas for the frame
         canvas = np.zeros((FRAME_SIZE[1], FRAME_SIZE[0]), dtype=np.uint8)
         
-        with open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
+        with instrument.span("load_manifest"), open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
             instructions = pickle.load(f)
+        instrument.count("tiles_per_frame", len(instructions))
         
-        for x, y, w, h, pdf_id in instructions:
-            if pdf_id == -1: # Solid Black (Already black by default)
-                continue
-            elif pdf_id == -2: # Solid White
-                canvas[y:y+h, x:x+w] = 255
-            else:
-                # If page is not in RAM, render it now
-                if pdf_id not in atlas:
-                    pdf_path, pg_idx = registry[pdf_id]
-                    
-                    # Keep PDF document open in memory to speed up access
-                    if pdf_path not in open_docs:
-                        open_docs[pdf_path] = pdfium.PdfDocument(pdf_path)
-                    
-                    doc = open_docs[pdf_path]
-                    page = doc[pg_idx]
-                    
-                    # Render at 2x scale for high detail in the tiles
-                    bitmap = page.render(scale=2.0).to_numpy()
-                    gray_page = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
-                    atlas[pdf_id] = gray_page
-                
-                # Resize the cached PDF page to fit the specific tile
-                patch = cv2.resize(atlas[pdf_id], (w, h), interpolation=cv2.INTER_AREA)
-                canvas[y:y+h, x:x+w] = patch
+        with instrument.span("assemble"):
+            for x, y, w, h, pdf_id in instructions:
+                if pdf_id == -1: # Solid Black (Already black by default)
+                    continue
+                elif pdf_id == -2: # Solid White
+                    canvas[y:y+h, x:x+w] = 255
+                else:
+                    # Resize the scheduled PDF page to fit the specific tile
+                    with instrument.tally("resize"):
+                        patch = cv2.resize(sched.get(pdf_id), (w, h), interpolation=cv2.INTER_AREA)
+                    canvas[y:y+h, x:x+w] = patch
         
         # Convert grayscale canvas to BGR for VideoWriter
-        final_frame = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
-        out.write(final_frame)
+        with instrument.span("encode"):
+            final_frame = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+            out.write(final_frame)
 
     # Cleanup
-    for doc in open_docs.values():
-        doc.close()
+    gov.stop()
+    sched.close()
+    print(sched.summary())
+    print(gov.summary())
     out.release()
     print(f"\n--- SUCCESS! Final video saved as {OUTPUT_VIDEO} ---")
+    instrument.finish()
 
 if __name__ == "__main__":
     render_video()
\ No newline at end of file
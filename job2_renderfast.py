@@ -2,11 +2,13 @@ import os
 import cv2
 import numpy as np
 import pickle
-import pypdfium2 as pdfium
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
-import subprocess
+import subprocess, threading, time
 from functools import lru_cache
+import atlas, instrument, membudget
+from atlas import AtlasScheduler, read_manifests, evict, page_cached, save_page, render_gray
+from membudget import bounded
 
 # --- CONFIG ---
 MANIFEST_DIR = "manifests"
@@ -29,58 +31,73 @@ TEST_MODE_LIMIT = None
 # High DPI for the PDFs
 PDF_RENDER_SCALE = 4.0 
 
+# Pages are rendered this many frames ahead of assembly
+# (upper bounds; membudget trims them and the worker count to BADAPPLE_MEM_BUDGET)
+LOOKAHEAD = 60
+TILE_CACHE = 10000
+RENDER_WORKERS = max(1, cpu_count() // 4)
+
+# Per-worker atlas, trimmed to the lookahead window on every frame
 _ATLAS = {}
 
-def worker_init(atlas_data):
-    global _ATLAS
-    _ATLAS = atlas_data
+def load_page(pdf_id):
+    if pdf_id not in _ATLAS:
+        instrument.count("atlas.misses")
+        img = atlas.load_page(ATLAS_DIR, pdf_id)
+        _ATLAS[pdf_id] = img if img is not None else np.zeros((100, 100), dtype=np.uint8)
+    return _ATLAS[pdf_id]
 
-@lru_cache(maxsize=10000)
+@lru_cache(maxsize=TILE_CACHE)
 def get_tile(pdf_id, nw, nh):
     nw, nh = max(1, nw), max(1, nh)
-    return cv2.resize(_ATLAS[pdf_id], (nw, nh), interpolation=cv2.INTER_LANCZOS4)
-
-def render_single_frame(m_file):
+    page = load_page(pdf_id)
+    # Only runs on a tile cache miss, so resize_calls in the trace = misses
+    with instrument.tally("resize"):
+        return cv2.resize(page, (nw, nh), interpolation=cv2.INTER_LANCZOS4)
+
+def init_worker(tile_cache):
+    """Resizes the per-worker tile cache to what the memory plan allows."""
+    global get_tile
+    get_tile = lru_cache(maxsize=tile_cache)(get_tile.__wrapped__)
+
+def render_single_frame(task):
+    m_file, live = task
+    evict(_ATLAS, live)
     canvas = np.full((H, W), 255, dtype=np.uint8) 
     try:
-        with open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
+        with instrument.span("load_manifest"), open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
             instructions = pickle.load(f)
-        for x, y, w, h, pdf_id in instructions:
-            nx, ny = x * SCALE_FACTOR, y * SCALE_FACTOR
-            nw, nh = w * SCALE_FACTOR, h * SCALE_FACTOR
-            if ny + nh > H: nh = H - ny
-            if nx + nw > W: nw = W - nx
-
-            if pdf_id == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
-            elif pdf_id == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
-            else:
-                canvas[ny:ny+nh, nx:nx+nw] = get_tile(pdf_id, nw, nh)
+        instrument.count("tiles_per_frame", len(instructions))
+        with instrument.span("assemble"):
+            for x, y, w, h, pdf_id in instructions:
+                nx, ny = x * SCALE_FACTOR, y * SCALE_FACTOR
+                nw, nh = w * SCALE_FACTOR, h * SCALE_FACTOR
+                if ny + nh > H: nh = H - ny
+                if nx + nw > W: nw = W - nx
+
+                if pdf_id == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
+                elif pdf_id == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
+                else:
+                    canvas[ny:ny+nh, nx:nx+nw] = get_tile(pdf_id, nw, nh)
     except: pass
     
     header = f"P5\n{W} {H}\n255\n".encode()
-    return header + canvas.tobytes()
+    with instrument.span("tobytes"):
+        return header + canvas.tobytes()
 
 def render_page_worker(task):
-    pdf_id, path, pg_idx = task
-    cache_path = os.path.join(ATLAS_DIR, f"{pdf_id}.png")
-    
-    # If it exists, LOAD IT (Forced grayscale)
-    if os.path.exists(cache_path):
-        img = cv2.imread(cache_path, cv2.IMREAD_GRAYSCALE)
-        if img is not None:
-            return pdf_id, img
-    
-    # If not, RENDER IT
-    try:
-        pdf = pdfium.PdfDocument(path)
-        page = pdf[pg_idx]
-        bitmap = page.render(scale=PDF_RENDER_SCALE).to_numpy()
-        gray = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2GRAY)
-        pdf.close()
-        cv2.imwrite(cache_path, gray)
-        return pdf_id, gray
-    except:
-        return pdf_id, np.zeros((100, 100), dtype=np.uint8)
+    path, pages = task
+    t0, rendered = time.perf_counter(), 0
+    for pdf_id, pg_idx in pages:
+        # Already on disk, nothing to do
+        if page_cached(ATLAS_DIR, pdf_id): continue
+        
+        # If not, RENDER IT (frame workers fall back to a blank page on failure)
+        try:
+            save_page(ATLAS_DIR, pdf_id, render_gray(path, pg_idx, PDF_RENDER_SCALE))
+            rendered += 1
+        except: pass
+    return {pdf_id: None for pdf_id, _ in pages}, rendered, time.perf_counter() - t0
 
 def main():
     if not os.path.exists(ATLAS_DIR): 
@@ -94,28 +111,13 @@ def main():
         print(f"--- TEST MODE ENABLED: {TEST_MODE_LIMIT} frames ---")
         manifest_files = manifest_files[:TEST_MODE_LIMIT]
 
-    # Quick scan of manifests
-    unique_ids = set()
-    for f in tqdm(manifest_files, desc="Scanning manifests for IDs"):
-        try:
-            with open(os.path.join(MANIFEST_DIR, f), "rb") as bf:
-                for entry in pickle.load(bf):
-                    if entry[4] >= 0: unique_ids.add(entry[4])
-        except: continue
-
-    # Check how many are already in the folder
-    cached_count = sum(1 for i in unique_ids if os.path.exists(os.path.join(ATLAS_DIR, f"{i}.png")))
-    print(f"--- Cache Check: {cached_count} / {len(unique_ids)} files found on disk ---")
-
-    atlas = {}
-    tasks = [(i, registry[i][0], registry[i][1]) for i in unique_ids]
-    
-    print(f"--- Loading Atlas (Disk + CPU) ---")
-    with Pool(cpu_count()) as p:
-        for pdf_id, img in tqdm(p.imap_unordered(render_page_worker, tasks), total=len(tasks)):
-            atlas[pdf_id] = img
-
-    print(f"--- Assembling Master 8K Video ---")
+    sample = membudget.sample_manifests(MANIFEST_DIR, manifest_files)
+    pages = membudget.frame_pages(MANIFEST_DIR, manifest_files)
+    plan = membudget.plan(W * H, membudget.page_bytes(PDF_RENDER_SCALE), pages,
+                          LOOKAHEAD, render_workers=RENDER_WORKERS,
+                          tile_bytes=membudget.mean_tile_area(sample) * SCALE_FACTOR**2, tile_cache=TILE_CACHE)
+    print(membudget.describe(plan))
+    print(f"--- Assembling Master 8K Video ({plan.lookahead} frame lookahead) ---")
     cmd = [
         'ffmpeg', '-y', '-framerate', str(FPS), '-f', 'image2pipe', '-vcodec', 'pgm', '-i', '-',
         '-c:v', 'libx264', '-crf', '0', '-g', '1', '-pix_fmt', 'gray', '-tune', 'stillimage',
@@ -123,9 +125,18 @@ def main():
     ]
     
     process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-    with Pool(cpu_count(), initializer=worker_init, initargs=(atlas,)) as p:
-        for frame_bytes in tqdm(p.imap(render_single_frame, manifest_files), total=len(manifest_files)):
-            process.stdin.write(frame_bytes)
+    slots = threading.Semaphore(plan.in_flight)
+    with AtlasScheduler(render_page_worker, registry, plan.lookahead, RENDER_WORKERS) as sched, \
+         Pool(plan.workers, initializer=init_worker, initargs=(plan.tile_cache,)) as p, \
+         membudget.Governor(plan, slots, sched) as gov:
+        frames = bounded(sched.schedule(read_manifests(MANIFEST_DIR, manifest_files)), slots)
+        for frame_bytes in tqdm(instrument.timed("frame.wait", p.imap(render_single_frame, frames)), total=len(manifest_files)):
+            with instrument.span("ffmpeg.write"):
+                process.stdin.write(frame_bytes)
+            instrument.count("ffmpeg.bytes", len(frame_bytes))
+            slots.release()
+        print(sched.summary())
+    print(gov.summary())
     process.stdin.close()
     process.wait()
 
@@ -134,6 +145,7 @@ def main():
         subprocess.run(['ffmpeg', '-y', '-i', OUTPUT_VIDEO, '-i', ORIGINAL_VIDEO, 
                         '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'aac', '-b:a', '256k', '-shortest', "Bad_Apple_8K_FINAL.mp4"])
         print("Masterpiece complete!")
+    instrument.finish()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
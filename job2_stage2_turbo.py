@@ -1,6 +1,8 @@
-import os, cv2, numpy as np, pickle, subprocess
+import os, cv2, numpy as np, pickle, subprocess, threading
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
+import instrument, membudget
+from membudget import bounded
 
 # --- CONFIG ---
 MANIFEST_DIR = "manifests_greedy"
@@ -11,6 +13,7 @@ OUTPUT_MOV = "Bad_Apple_Dynamic.mov"
 SCALE_FACTOR = 16 
 W, H = 512 * SCALE_FACTOR, 384 * SCALE_FACTOR
 IMG_SIZE = 2048 
+PIPE_BUFFER = 5 * 10**8 # Huge buffer ensures Python never waits for FFmpeg
 
 _BLOB = None
 
@@ -22,26 +25,31 @@ def worker_init(blob_path, total_pages):
 def render_frame(m_file):
     # Grayscale 16K Canvas
     canvas = np.full((H, W), 255, dtype=np.uint8)
-    with open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
+    with instrument.span("load_manifest"), open(os.path.join(MANIFEST_DIR, m_file), "rb") as f:
         instructions = pickle.load(f)
+    instrument.count("tiles_per_frame", len(instructions))
     
-    for x, y, w, h, pid in instructions:
-        nx, ny, nw, nh = x*SCALE_FACTOR, y*SCALE_FACTOR, w*SCALE_FACTOR, h*SCALE_FACTOR
-        if pid == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
-        elif pid == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
-        else:
-            img = _BLOB[pid]
-            # Fast aspect-fit logic
-            ih, iw = img.shape
-            as_src, as_tar = iw/ih, nw/nh
-            tw, th = (nw, int(nw/as_src)) if as_src > as_tar else (int(nh*as_src), nh)
+    # memmap page faults land inside resize; the span records minflt/majflt
+    with instrument.span("assemble"):
+        for x, y, w, h, pid in instructions:
+            nx, ny, nw, nh = x*SCALE_FACTOR, y*SCALE_FACTOR, w*SCALE_FACTOR, h*SCALE_FACTOR
+            if pid == -1: canvas[ny:ny+nh, nx:nx+nw] = 0
+            elif pid == -2: canvas[ny:ny+nh, nx:nx+nw] = 255
+            else:
+                img = _BLOB[pid]
+                # Fast aspect-fit logic
+                ih, iw = img.shape
+                as_src, as_tar = iw/ih, nw/nh
+                tw, th = (nw, int(nw/as_src)) if as_src > as_tar else (int(nh*as_src), nh)
+                
+                # Use INTER_AREA for maximum speed at 16K
+                with instrument.tally("resize"):
+                    resized = cv2.resize(img, (max(1,tw), max(1,th)), interpolation=cv2.INTER_AREA)
+                y_off, x_off = (nh-th)//2, (nw-tw)//2
+                canvas[ny+y_off:ny+y_off+th, nx+x_off:nx+x_off+tw] = resized
             
-            # Use INTER_AREA for maximum speed at 16K
-            resized = cv2.resize(img, (max(1,tw), max(1,th)), interpolation=cv2.INTER_AREA)
-            y_off, x_off = (nh-th)//2, (nw-tw)//2
-            canvas[ny+y_off:ny+y_off+th, nx+x_off:nx+x_off+tw] = resized
-            
-    return canvas.tobytes()
+    with instrument.span("tobytes"):
+        return canvas.tobytes()
 
 def main():
     if not os.path.exists(BINARY_ATLAS):
@@ -51,6 +59,10 @@ def main():
     total_pages = file_size // (IMG_SIZE * IMG_SIZE)
     manifests = sorted([f for f in os.listdir(MANIFEST_DIR) if f.endswith(".bin")])
 
+    # The blob is a shared memmap (page cache), so only canvases count against the budget
+    plan = membudget.plan(W * H, pipe_buffer=PIPE_BUFFER)
+    print(membudget.describe(plan))
+
     # Turbo FFmpeg Settings
     cmd = [
         'ffmpeg', '-y', '-framerate', '30', '-f', 'rawvideo', '-pix_fmt', 'gray',
@@ -59,22 +71,26 @@ def main():
         '-pix_fmt', 'yuv422p10le', '-movflags', '+faststart', '-fps_mode', 'cfr', 
         '-threads', 'auto', 'temp_master.mov'
     ]
-    # Huge buffer (500MB) ensures Python never waits for FFmpeg
-    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=5 * 10**8)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=PIPE_BUFFER)
 
-    # Use 16-20 workers to leave room for FFmpeg and OS
-    num_workers = max(1, int(cpu_count() * 0.75))
-    print(f"--- Assembling 16K with {num_workers} workers ---")
+    print(f"--- Assembling 16K with {plan.workers} workers ---")
     
-    with Pool(num_workers, initializer=worker_init, initargs=(BINARY_ATLAS, total_pages)) as p:
+    slots = threading.Semaphore(plan.in_flight)
+    with Pool(plan.workers, initializer=worker_init, initargs=(BINARY_ATLAS, total_pages)) as p, \
+         membudget.Governor(plan, slots) as gov:
         # chunksize=1 is important for order in imap
-        for frame_bytes in tqdm(p.imap(render_frame, manifests), total=len(manifests)):
-            proc.stdin.write(frame_bytes)
+        for frame_bytes in tqdm(instrument.timed("frame.wait", p.imap(render_frame, bounded(manifests, slots))), total=len(manifests)):
+            with instrument.span("ffmpeg.write"):
+                proc.stdin.write(frame_bytes)
+            instrument.count("ffmpeg.bytes", len(frame_bytes))
+            slots.release()
+    print(gov.summary())
 
     proc.stdin.close(); proc.wait()
     
     # Sync Audio
     subprocess.run(['ffmpeg', '-y', '-i', 'temp_master.mov', '-i', ORIGINAL_VIDEO,
                     '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'aac', '-shortest', 'BAD_APPLE_16K_ULTRA_FINAL.mov'])
+    instrument.finish()
 
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os, sys, ctypes, pickle, time
+import numpy as np
+import instrument
+
+# --- CONFIG ---
+MATCHER = os.environ.get("BADAPPLE_MATCHER", "auto") # auto | c | numpy
+LIB_PATH = "./libmatch.so"    # Linux shared object for WSL
+CHUNK_BYTES = 64 * 2**20      # XOR scratch per NumPy chunk
+
+# Verification mode (python matcher.py)
+LIB_CACHE = "library.pkl"
+VIDEO_PATH = "badapple.mp4"
+VERIFY_FRAMES = 20            # Frames sampled evenly across the video
+
+# Set bits per byte value, and per 16-bit value for NumPy < 2 (no np.bitwise_count)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+POPCOUNT16 = (POPCOUNT[:, None] + POPCOUNT[None, :]).ravel() if not hasattr(np, "bitwise_count") else None
+
+class CMatcher:
+    """The OpenMP kernel in match.c."""
+    name = "c"
+
+    def __init__(self, lib_path=LIB_PATH):
+        if not os.path.exists(lib_path):
+            raise OSError(f"{lib_path} not found. Did you compile match.c?")
+        self.lib = ctypes.CDLL(lib_path)
+        self.lib.match_batch.argtypes = [
+            ctypes.POINTER(ctypes.c_uint64), # lib
+            ctypes.POINTER(ctypes.c_uint64), # targets
+            ctypes.c_int,                   # n_pages
+            ctypes.c_int,                   # num_targets
+            ctypes.POINTER(ctypes.c_int)    # results
+        ]
+
+    def match(self, signatures, targets):
+        signatures = np.ascontiguousarray(signatures, dtype=np.uint64)
+        targets = np.ascontiguousarray(targets, dtype=np.uint64)
+        results = np.zeros(len(targets), dtype=np.int32)
+        self.lib.match_batch(
+            signatures.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)),
+            targets.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)),
+            len(signatures), len(targets),
+            results.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+        )
+        return results
+
+class NumpyMatcher:
+    """Pure NumPy fallback: chunked XOR plus np.bitwise_count (a 16-bit lookup table on NumPy < 2).
+
+    Same answer as the C kernel, including ties (lowest page ID wins), but still one to
+    two orders of magnitude slower.
+    """
+    name = "numpy"
+
+    def match(self, signatures, targets):
+        signatures = np.asarray(signatures, dtype=np.uint64).reshape(-1, 64)
+        targets = np.asarray(targets, dtype=np.uint64).reshape(-1, 64)
+        best = np.zeros(len(targets), dtype=np.int32)
+        best_dist = np.full(len(targets), np.iinfo(np.uint16).max, dtype=np.uint16)
+        # Library rows per chunk so the (rows, targets, 64) uint64 XOR scratch fits CHUNK_BYTES
+        step = max(1, CHUNK_BYTES // max(1, len(targets) * 512))
+        for start in range(0, len(signatures), step):
+            chunk = signatures[start:start + step]
+            xor = chunk[:, None, :] ^ targets[None, :, :]
+            if POPCOUNT16 is None:
+                dist = np.bitwise_count(xor).sum(axis=2, dtype=np.uint16)  # (rows, targets)
+            else:
+                dist = POPCOUNT16[xor.view(np.uint16)].sum(axis=2, dtype=np.uint16)
+            idx = dist.argmin(axis=0)
+            d = dist[idx, np.arange(len(targets))]
+            # Strictly better only, so earlier chunks keep ties like the C loop
+            better = d < best_dist
+            best[better] = idx[better] + start
+            best_dist[better] = d[better]
+        return best
+
+BACKENDS = {"c": CMatcher, "numpy": NumpyMatcher}
+
+_MATCHER = None
+
+def get_matcher(name=None):
+    """Backend selected by MATCHER; 'auto' uses the C kernel when libmatch.so loads."""
+    global _MATCHER
+    name = name or MATCHER
+    if name == "auto":
+        if _MATCHER is None:
+            try:
+                _MATCHER = CMatcher()
+            except OSError as e:
+                slower = "5-40x" if POPCOUNT16 is None else "10-150x" # Wider gap the more cores OpenMP gets
+                print(f"WARNING: {e} Falling back to the NumPy matcher: expect matching to run about "
+                      f"{slower} slower than the C kernel, so job1_* will take much longer.")
+                _MATCHER = NumpyMatcher()
+        return _MATCHER
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown matcher backend '{name}' (expected one of {sorted(BACKENDS)} or 'auto')")
+    if _MATCHER is None or _MATCHER.name != name:
+        _MATCHER = BACKENDS[name]()
+    return _MATCHER
+
+def match_batch(signatures, targets):
+    """Best library page ID per 64x64 target bitmask, using the configured backend."""
+    instrument.count("match.tiles", len(targets))
+    with instrument.span("match_batch"):
+        return get_matcher().match(signatures, targets)
+
+def hamming(signatures, ids, targets):
+    return POPCOUNT[(signatures[ids] ^ targets).view(np.uint8)].sum(axis=1)
+
+def verify(signatures, targets, backends=("c", "numpy")):
+    """Runs every backend on the same targets and reports mismatches against the first.
+
+    Returns (results, timings, errors); errors counts mismatches that are not equal-distance ties.
+    """
+    results, timings, errors = {}, {}, 0
+    for name in backends:
+        m = BACKENDS[name]()
+        t0 = time.perf_counter()
+        results[name] = m.match(signatures, targets)
+        timings[name] = time.perf_counter() - t0
+
+    ref = backends[0]
+    print(f"--- Verified {len(targets)} tiles against {len(signatures)} pages ---")
+    for name in backends:
+        rate = len(targets) / timings[name] if timings[name] > 0 else float("inf")
+        line = f"{name:>6}: {timings[name]:.3f}s  {rate:,.0f} tiles/s  {timings[ref] / timings[name]:.2f}x vs {ref}"
+        if name != ref:
+            diff = np.nonzero(results[name] != results[ref])[0]
+            # Same distance, different ID = tie broken differently; anything else is a real bug
+            ties = int((hamming(signatures, results[name][diff], targets[diff]) ==
+                        hamming(signatures, results[ref][diff], targets[diff])).sum())
+            line += f"  mismatches: {len(diff)} ({ties} equal-distance ties)"
+            errors += len(diff) - ties
+        print(line)
+    return results, timings, errors
+
+def sample_targets(n_frames=VERIFY_FRAMES):
+    """Detail tiles from frames spread evenly over the video, via the quadtree decomposition."""
+    import cv2
+    from job1_arrange import decompose_frame
+    cap = cv2.VideoCapture(VIDEO_PATH)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    targets = []
+    for idx in np.linspace(0, max(0, total - 1), n_frames).astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(idx))
+        ret, frame = cap.read()
+        if not ret: continue
+        targets.extend(decompose_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))[1])
+    cap.release()
+    return np.array(targets, dtype=np.uint64).reshape(-1, 64)
+
+if __name__ == "__main__":
+    _, signatures = pickle.load(open(LIB_CACHE, "rb"))
+    try:
+        CMatcher()
+    except OSError as e:
+        print(f"ERROR: cannot load the C backend: {e}"); sys.exit(2)
+    _, _, errors = verify(signatures, sample_targets())
+    if errors:
+        print(f"ERROR: {errors} tiles matched a page at a different distance than the C kernel"); sys.exit(1)
+    print("--- OK: backends agree ---")
@@ -0,0 +1,247 @@
+import os, re, sys, pickle, threading
+from collections import namedtuple
+from multiprocessing import cpu_count
+import instrument
+from atlas import read_manifests
+
+# --- CONFIG ---
+# Memory the render stage may use in total (main process, pool workers and ffmpeg),
+# e.g. BADAPPLE_MEM_BUDGET=24G. Unset = MEM_FRACTION of what is available at start.
+MEM_BUDGET = os.environ.get("BADAPPLE_MEM_BUDGET", "")
+MEM_FRACTION = 0.8
+
+# Cost model, all per process
+BASE_MB = 120          # Interpreter + numpy/cv2/pdfium before any work
+FRAME_COPIES = 4       # Canvas, tobytes(), its pickled copy and a resize temporary
+RASTER_COPIES = 6      # BGRA bitmap, gray and normalized copies of a page being rasterized
+PAGE_POINTS = 612 * 792 # US Letter; pages at PDF scale s are about PAGE_POINTS * s^2 gray bytes
+SAMPLE_FRAMES = 300    # Manifests read to measure the mean tile size...
+SAMPLE_BLOCKS = 10     # ...as contiguous blocks spread over the whole video
+
+# Floors the planner shrinks towards, in this order, before it drops workers
+MIN_TILE_CACHE = 256
+MIN_LOOKAHEAD = 8
+
+# Runtime governor
+POLL_INTERVAL = 0.5    # Seconds between RSS readings of the process tree
+HIGH_WATER = 0.90      # Above this share of the budget, take frame slots away
+LOW_WATER = 0.75       # Below it, hand them back one at a time
+
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+Plan = namedtuple("Plan", "budget workers lookahead in_flight tile_cache estimate")
+
+SIZE_FORMAT = "bytes or a number with K/M/G/T, optionally followed by B or iB (e.g. 24G, 24GiB, 512MB)"
+
+def parse_size(text):
+    """'24G', '24GiB', '512MB', '1.5T' or plain bytes; units are binary. ValueError otherwise."""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d*)?|\.\d+)\s*(?:([KMGT])I?)?B?\s*", text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"not a size: {text!r}")
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    return int(float(m.group(1)) * units.get((m.group(2) or "").upper(), 1))
+
+def available_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PHYS_PAGES") * _PAGE
+
+def budget_bytes():
+    if not MEM_BUDGET:
+        return int(available_bytes() * MEM_FRACTION)
+    try:
+        return parse_size(MEM_BUDGET)
+    except ValueError:
+        print(f"ERROR: BADAPPLE_MEM_BUDGET={MEM_BUDGET!r} is not a size. Use {SIZE_FORMAT}."); sys.exit(2)
+
+def page_bytes(pdf_scale):
+    """Rough gray footprint of one rasterized page."""
+    return int(PAGE_POINTS * pdf_scale ** 2)
+
+# --- OBSERVED RSS ---
+def _children():
+    kids = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue # Exited while we were looking
+        kids.setdefault(ppid, []).append(int(entry))
+    return kids
+
+def tree_rss(root=None):
+    """Private resident bytes of a process and all its descendants (pool workers, ffmpeg).
+
+    Shared file pages (the turbo memmap, libraries) are reclaimable page cache and
+    would be counted once per worker, so they are left out.
+    """
+    if not os.path.isdir("/proc"):
+        return int(instrument.rss_mb() * 2**20)
+    kids, todo, total = _children(), [root or os.getpid()], 0
+    while todo:
+        pid = todo.pop()
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                resident, shared = map(int, f.read().split()[1:3])
+            total += (resident - shared) * _PAGE
+        except OSError:
+            pass
+        todo.extend(kids.get(pid, ()))
+    return total
+
+# --- PLANNING ---
+def frame_pages(manifest_dir, manifest_files):
+    """Page IDs of every frame, streamed through all manifests.
+
+    Openings are often near-static, so a prefix would underestimate the busy sections.
+    """
+    return [pids for _, pids in read_manifests(manifest_dir, manifest_files)]
+
+def sample_manifests(manifest_dir, manifest_files, n=SAMPLE_FRAMES, blocks=SAMPLE_BLOCKS):
+    """Instructions of about n manifests in evenly spread blocks, to size the tile cache from."""
+    size = max(1, n // blocks)
+    starts = range(0, len(manifest_files), max(size, len(manifest_files) // blocks))
+    sample = []
+    for m_file in [f for start in starts for f in manifest_files[start:start + size]]:
+        try:
+            with open(os.path.join(manifest_dir, m_file), "rb") as f:
+                sample.append(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    return sample
+
+def mean_tile_area(sample):
+    """Average source-resolution area of the PDF tiles in sampled manifests."""
+    areas = [w * h for m in sample for _, _, w, h, pid in m if pid is not None and pid >= 0]
+    return sum(areas) / len(areas) if areas else 0
+
+def window_pages(frame_pages, lookahead):
+    """Most distinct pages any window of lookahead + 1 consecutive frames touches."""
+    counts, best, span = {}, 0, lookahead + 1
+    for i, pids in enumerate(frame_pages):
+        for pid in pids:
+            counts[pid] = counts.get(pid, 0) + 1
+        if i >= span:
+            for pid in frame_pages[i - span]:
+                counts[pid] -= 1
+                if not counts[pid]: del counts[pid]
+        best = max(best, len(counts))
+    return best
+
+def plan(frame_bytes, page_bytes=0, frame_pages=(), lookahead=0, max_workers=None,
+         render_workers=0, tile_bytes=0, tile_cache=0, pipe_buffer=0, budget=None):
+    """Largest render setup whose estimated footprint fits the budget.
+
+    frame_bytes is the canvas (W*H for gray), frame_pages the page IDs of every
+    frame (see frame_pages) and tile_bytes the mean cached tile. Every frame worker
+    is assumed to end up holding the whole lookahead window of pages; with
+    max_workers=0 the frames are assembled in the main process instead.
+    Starts from max_workers, the requested lookahead and tile cache, then halves the
+    tile cache, then the lookahead, then drops workers until the estimate fits.
+    """
+    budget = budget or budget_bytes()
+    max_workers = cpu_count() if max_workers is None else max_workers
+    frame_pages = [set(p) for p in frame_pages]
+    windows = {}
+
+    def cost(workers, lookahead, tile_cache):
+        if lookahead not in windows: windows[lookahead] = window_pages(frame_pages, lookahead)
+        assemblers = max(1, workers)
+        in_flight = 2 * workers
+        return (BASE_MB * 2**20 * (1 + workers + render_workers) + pipe_buffer
+                + (in_flight + 1) * frame_bytes                       # Finished frames queued in main
+                + render_workers * RASTER_COPIES * page_bytes
+                + assemblers * windows[lookahead] * page_bytes
+                + assemblers * (FRAME_COPIES * frame_bytes + tile_cache * tile_bytes))
+
+    workers = max_workers
+    while cost(workers, lookahead, tile_cache) > budget:
+        if tile_cache > MIN_TILE_CACHE: tile_cache = max(MIN_TILE_CACHE, tile_cache // 2)
+        elif lookahead > MIN_LOOKAHEAD: lookahead = max(MIN_LOOKAHEAD, lookahead // 2)
+        elif workers > 1: workers -= 1
+        else:
+            print(f"WARNING: even 1 worker needs ~{cost(workers, lookahead, tile_cache) / 2**30:.1f} GiB "
+                  f"of a {budget / 2**30:.1f} GiB budget. Continuing; the governor will throttle.")
+            break
+    return Plan(budget, workers, lookahead, max(1, 2 * workers), tile_cache, cost(workers, lookahead, tile_cache))
+
+def describe(p):
+    parts = [f"{p.workers} workers" if p.workers else "assembling in main"]
+    if p.lookahead: parts.append(f"{p.lookahead} frame lookahead")
+    if p.workers: parts.append(f"{p.in_flight} frames in flight")
+    if p.tile_cache: parts.append(f"{p.tile_cache} cached tiles/worker")
+    return (f"--- Memory plan: {p.budget / 2**30:.1f} GiB budget -> {', '.join(parts)} "
+            f"(est. {p.estimate / 2**30:.1f} GiB) ---")
+
+# --- RUNTIME ---
+def bounded(items, slots):
+    """Blocks the producer once `slots` frames are in flight downstream.
+
+    Pool.imap drains its input as fast as it can, so each stage takes a slot
+    before handing a frame on and the next stage gives it back.
+    """
+    for item in items:
+        slots.acquire()
+        yield item
+
+class Governor:
+    """Adapts a running render to the RSS it actually observes.
+
+    Polls the private RSS of this process tree. Above HIGH_WATER of the budget it
+    withholds one frame slot per poll (down to a single frame in flight) and halves
+    the scheduler's lookahead; below LOW_WATER it gives them back step by step.
+    slots is the semaphore that bounded() draws from; either argument may be None.
+    """
+
+    def __init__(self, plan, slots=None, sched=None, interval=POLL_INTERVAL):
+        self.plan, self.slots, self.sched, self.interval = plan, slots, sched, interval
+        self.held = 0          # Slots taken away from the frame stream
+        self.throttles = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        for _ in range(self.held): self.slots.release()
+        self.held = 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = tree_rss()
+            self.peak = max(self.peak, rss)
+            instrument.count("mem.tree_mb", rss / 2**20)
+            if rss > HIGH_WATER * self.plan.budget:
+                self.throttles += 1
+                if self.slots and self.held < self.plan.in_flight - 1 and self.slots.acquire(blocking=False):
+                    self.held += 1
+                if self.sched and self.sched.lookahead > MIN_LOOKAHEAD:
+                    self.sched.lookahead = max(MIN_LOOKAHEAD, self.sched.lookahead // 2)
+            elif rss < LOW_WATER * self.plan.budget:
+                if self.held:
+                    self.slots.release()
+                    self.held -= 1
+                elif self.sched and self.sched.lookahead < self.plan.lookahead:
+                    self.sched.lookahead = min(self.plan.lookahead, self.sched.lookahead * 2)
+
+    def summary(self):
+        return (f"--- Memory: peak {self.peak / 2**30:.1f} GiB of {self.plan.budget / 2**30:.1f} GiB budget, "
+                f"throttled on {self.throttles} polls ---")
@@ -0,0 +1,133 @@
+import os, cv2, pickle, subprocess, threading
+from tqdm import tqdm
+from multiprocessing import Pool, cpu_count
+from atlas import AtlasScheduler, manifest_pids
+from membudget import bounded
+import job1_arrange, job1_greedy_arrange, job1_hyper_arrange
+import job2_greedy_render, job2_proxy_render
+import instrument
+
+# --- CONFIG ---
+# Single entry point: decode -> arrange -> render -> ffmpeg, frame by frame.
+# Meant for previewing parameter changes (MIN_BLOCK, SCALE_FACTOR, thresholds)
+# without waiting for a full job1 pass; manifests are still written on the side.
+VIDEO_PATH = "badapple.mp4"
+LIB_CACHE = "library.pkl"
+MANIFEST_DIR = "manifests_pipeline"    # Side output, same format as job1_*
+OUTPUT_VIDEO = "bad_apple_pipeline.mp4"
+
+STRATEGY = "greedy"        # quadtree (job1_arrange) | greedy | hyper
+SCALE_FACTOR = 2           # Rendered with job2_greedy_render (pages land in its ATLAS_DIR)
+PROXY = False              # Assemble from the ingest thumbnails instead (no PDF access)
+FPS = 30
+
+QUEUE_SIZE = 8             # Frames buffered between each pair of stages
+LOOKAHEAD = 8              # Atlas lookahead, kept short so the first frame comes out fast
+ARRANGE_WORKERS = max(1, cpu_count() // 2)
+FRAME_WORKERS = max(1, cpu_count() // 4)
+RENDER_WORKERS = max(1, cpu_count() // 4)
+
+# Set to None for the full video, or 300 for a 10-second test
+TEST_MODE_LIMIT = None
+
+def decode_frames():
+    cap = cv2.VideoCapture(VIDEO_PATH)
+    idx = 0
+    while TEST_MODE_LIMIT is None or idx < TEST_MODE_LIMIT:
+        with instrument.span("decode"):
+            ret, frame = cap.read()
+            if not ret: break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        yield idx, gray
+        idx += 1
+    cap.release()
+
+# --- ARRANGE WORKERS ---
+_SIGS = None
+_NPAGES = 0
+_HERO = None
+
+def init_arrange_worker(sigs, n_pages):
+    global _SIGS, _NPAGES, _HERO
+    _SIGS, _NPAGES = sigs, n_pages
+    if STRATEGY == "greedy":
+        _HERO = job1_greedy_arrange.hero_pages(sigs)
+    elif STRATEGY == "hyper":
+        b_pool, w_pool = job1_hyper_arrange.hero_pools(sigs)
+        job1_hyper_arrange.init_worker(sigs, n_pages, w_pool, b_pool)
+
+def arrange_worker(task):
+    idx, gray = task
+    if STRATEGY == "quadtree":
+        return idx, job1_arrange.arrange_frame(gray, _SIGS, _NPAGES)
+    if STRATEGY == "greedy":
+        return idx, job1_greedy_arrange.solve_greedy_accurate(gray, _SIGS, _NPAGES, *_HERO)
+    return idx, job1_hyper_arrange.solve_frame(idx, gray)
+
+def render_worker(task):
+    (idx, manifest), live = task
+    with instrument.span("assemble"):
+        if PROXY:
+            canvas = job2_proxy_render.assemble_proxy(manifest, SCALE_FACTOR)
+        else:
+            canvas = job2_greedy_render.assemble_frame(manifest, live, SCALE_FACTOR)
+    with instrument.span("tobytes"):
+        return canvas.tobytes()
+
+def main():
+    if STRATEGY not in ("quadtree", "greedy", "hyper"):
+        print(f"ERROR: Unknown STRATEGY '{STRATEGY}'"); return
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    os.makedirs(job2_greedy_render.ATLAS_DIR, exist_ok=True)
+    if PROXY and not os.path.exists(job2_proxy_render.THUMB_CACHE):
+        print(f"ERROR: {job2_proxy_render.THUMB_CACHE} not found. Run job1_arrange to build it!"); return
+
+    registry, signatures = pickle.load(open(LIB_CACHE, "rb"))
+    error = PROXY and job2_proxy_render.check_thumbs(registry)
+    if error:
+        print(error); return
+    cap = cv2.VideoCapture(VIDEO_PATH)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if TEST_MODE_LIMIT: total = min(total, TEST_MODE_LIMIT)
+
+    W, H = 512 * SCALE_FACTOR, 384 * SCALE_FACTOR
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(FPS), '-f', 'rawvideo',
+        '-pix_fmt', 'gray', '-s', f'{W}x{H}', '-i', '-',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18', '-pix_fmt', 'yuv420p', OUTPUT_VIDEO
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    arrange_slots = threading.Semaphore(QUEUE_SIZE)
+    render_slots = threading.Semaphore(QUEUE_SIZE)
+
+    def arranged(results):
+        # Side output: the same manifests job1_* would have written
+        for idx, manifest in results:
+            arrange_slots.release()
+            with instrument.span("write_manifest"), open(f"{MANIFEST_DIR}/{idx:04d}.bin", "wb") as f:
+                pickle.dump(manifest, f)
+            yield (idx, manifest), manifest_pids(manifest)
+
+    print(f"--- Pipeline: {STRATEGY} arrange -> {W}x{H} {'proxy ' if PROXY else ''}render ({total} frames) ---")
+    # Scheduler first so every pool forks from the main thread before the stage threads start
+    sched = None if PROXY else AtlasScheduler(job2_greedy_render.render_page_worker, registry, LOOKAHEAD, RENDER_WORKERS)
+    with Pool(ARRANGE_WORKERS, initializer=init_arrange_worker, initargs=(signatures, len(registry))) as arrange_pool, \
+         Pool(FRAME_WORKERS, initializer=job2_proxy_render.load_thumbs if PROXY else None) as frame_pool:
+        manifests = arranged(arrange_pool.imap(arrange_worker, bounded(decode_frames(), arrange_slots)))
+        frames = ((m, None) for m, _ in manifests) if PROXY else sched.schedule(manifests)
+        results = frame_pool.imap(render_worker, bounded(frames, render_slots))
+        for frame_bytes in tqdm(instrument.timed("frame.wait", results), total=total, desc="Pipeline"):
+            with instrument.span("ffmpeg.write"):
+                proc.stdin.write(frame_bytes)
+            render_slots.release()
+    if sched:
+        sched.close()
+        print(sched.summary())
+
+    proc.stdin.close(); proc.wait()
+    print(f"--- Preview saved as {OUTPUT_VIDEO} ---")
+    instrument.finish()
+
+if __name__ == "__main__": main()